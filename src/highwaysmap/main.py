@@ -3,10 +3,19 @@ Web app to map the highways agency road closures.
 
 """
 
-import json
+import asyncio
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 from zoneinfo import ZoneInfo
@@ -16,8 +25,12 @@ from dateutil.relativedelta import relativedelta
 
 import flask
 import folium
+import ijson
+import numpy as np
+import orjson
 import requests
 from flask_compress import Compress
+from requests.adapters import HTTPAdapter
 from waitress import serve
 
 
@@ -37,6 +50,18 @@ if app.key is None:
 # Enable compression on rendered pages
 Compress(app)
 
+# Keep the rendered map HTML in memory between refreshes so we don't have to hit the disk on every request. Waitress
+# serves requests from a pool of threads, so guard access with a lock.
+app._map_cache = {"html": None, "etag": None, "mtime": 0, "closures": None}
+app._map_cache_lock = threading.Lock()
+
+# Reuse the connection to the API between refreshes rather than doing a fresh TCP and TLS handshake each time.
+_api_session = requests.Session()
+_api_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+# How often (in seconds) the background thread checks whether the map needs refreshing.
+REFRESH_INTERVAL = 900
+
 
 def run() -> None:
     """
@@ -45,13 +70,18 @@ def run() -> None:
     """
 
     if os.environ.get("LOGLEVEL") == "DEBUG":
+        use_reloader = bool(os.environ.get("RELOADER", True))
+        # With the reloader on, only refresh the map in the child process which actually serves the app.
+        if not use_reloader or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            start_refresher(app.key)
         app.run(
             host=os.environ.get("HOST", "127.0.0.1"),
             port=int(os.environ.get("PORT", 5000)),
-            use_reloader=bool(os.environ.get("RELOADER", True)),
+            use_reloader=use_reloader,
             debug=True,
         )
     else:
+        start_refresher(app.key)
         serve(
             app,
             host=os.environ.get("HOST", "127.0.0.1"),
@@ -81,6 +111,20 @@ class Map(folium.Map):
         self.default_css = fixed_css
 
 
+# The HTML for each closure's tooltip; filled in from the closure info.
+TOOLTIP_TEMPLATE = """
+<div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.4;">
+    <b>Name:</b> {name}<br>
+    <b>Description:</b> {description}<br>
+    <b>From:</b> {start}<br>
+    <b>To:</b> {end}<br>
+    <b>Cause:</b> {cause}<br>
+    <b>Open carriageways:</b> {open}<br>
+    <b>Closed carriageways:</b> {closed}
+</div>
+"""
+
+
 @dataclass
 class Closure:
     """
@@ -95,7 +139,7 @@ class Closure:
 
     Methods:
         process: Process the closures.
-        from_dict: Populate an instance of this object with data from a dictionary.
+        to_render_dict: Reduce the closure to what's needed to draw it.
 
     """
 
@@ -122,19 +166,22 @@ class Closure:
             self.process(self.location)
 
     def process(self, location):
-        total_road_names = len(location["locationReferencingPointLocation"]["pointAlongLinearElement"])
-        for iiii, point in enumerate(location["locationReferencingPointLocation"]["pointAlongLinearElement"], 1):
-            logger.debug("      Processing %d of %d road names", iiii, total_road_names)
-            if point["linearElement"]["roadName"] not in self.road_names:
-                self.road_names.append(point["linearElement"]["roadName"])
-        flat_coordinates = location["locationReferencingLinearLocation"]["gmlLineString"]["posList"].split()
+        # Pull out the bits of the location we need once rather than walking down to them every time
+        points = location["locationReferencingPointLocation"]["pointAlongLinearElement"]
+        linear_location = location["locationReferencingLinearLocation"]
+        carriageways = linear_location["supplementaryPositionalDescription"]["carriageway"]
+
+        # Keep the unique road names in the order we find them
+        self.road_names = list(dict.fromkeys(point["linearElement"]["roadName"] for point in points))
+        logger.debug("      Found %d road names in %d points", len(self.road_names), len(points))
         lanes = {"open": [], "closed": []}
-        total_carriageways = len(location["locationReferencingLinearLocation"]["supplementaryPositionalDescription"]["carriageway"])
-        for iiiii, carriageway in enumerate(location["locationReferencingLinearLocation"]["supplementaryPositionalDescription"]["carriageway"], 1):
+        total_carriageways = len(carriageways)
+        for iiiii, carriageway in enumerate(carriageways, 1):
             logger.debug("      Processing %d of %d carriageways", iiiii, total_carriageways)
             if "_carriagewayExtensionG" in carriageway:
-                lanes["open"].append(carriageway["_carriagewayExtensionG"]["numberOfOperationalLanes"])
-                lanes["closed"].append(carriageway["_carriagewayExtensionG"]["numberOfLanesRestricted"])
+                extension = carriageway["_carriagewayExtensionG"]
+                lanes["open"].append(extension["numberOfOperationalLanes"])
+                lanes["closed"].append(extension["numberOfLanesRestricted"])
 
         if lanes["open"]:
             for key, value in lanes.items():
@@ -157,23 +204,178 @@ class Closure:
         self.info["open"] = lanes["open"]
         self.info["closed"] = lanes["closed"]
 
-        # Flip to lat/lon pairs for the folium stuff
-        self.coordinates = [
-            [float(j) for j in flat_coordinates[i : i + 2][::-1]]
-            for i in range(0, len(flat_coordinates), 2)
-        ]
+        # The positions come as lon/lat pairs, which is just what GeoJSON wants
+        coordinates = np.fromstring(linear_location["gmlLineString"]["posList"], sep=" ")
+        self.coordinates = coordinates.reshape(-1, 2)
 
-    def from_dict(self, dictionary):
+    def to_render_dict(self, colours, pretty_causes):
         """
-        Load closures from a dictionary into an instance of this object.
+        Boil the closure down to just what's needed to draw it on the map.
 
         Args:
-            dictionary (dict): The dictionary from which to re-populate the attributes of this dataclass.
+            colours (dict): The line colour for each closure cause.
+            pretty_causes (dict): The human readable name for each closure cause.
+
+        Returns:
+            closure (dict): The coordinates, colour, opacity, tooltip HTML and cause of the closure.
 
         """
 
-        for k, v in dictionary.items():
-            setattr(self, k, v)
+        return {
+            "coordinates": self.coordinates,
+            "color": colours[self.cause],
+            "alpha": self.alpha,
+            "tooltip_html": TOOLTIP_TEMPLATE.format_map(self.info | {"cause": pretty_causes[self.cause]}),
+            "cause": self.cause,
+        }
+
+
+# A single incident is often spread over lots of records, so the same few timestamps come up again and again. Cache
+# the parsing and formatting of them.
+@lru_cache(maxsize=4096)
+def parse_time(timestamp: str) -> datetime:
+    """
+    Parse a timestamp from the API.
+
+    Args:
+        timestamp (str): The ISO format timestamp, possibly with a 'Z' suffix.
+
+    Returns:
+        when (datetime): The parsed timestamp.
+
+    """
+
+    # Replace 'Z' with +00:00 to make a valid ISO spec time
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
+@lru_cache(maxsize=4096)
+def format_time(when: datetime, time_format: str) -> str:
+    """
+    Format a time for display.
+
+    Args:
+        when (datetime): The time to format.
+        time_format (str): The time string formatting.
+
+    Returns:
+        formatted (str): The formatted time.
+
+    """
+
+    return when.strftime(time_format)
+
+
+# Number of situations to hand to each worker process at a time.
+SITUATION_CHUNK_SIZE = 32
+
+# Number of situations to process in this process before it's worth starting worker processes for the rest. Starting
+# a forkserver pool takes ~0.45s and each situation costs ~0.15ms to push through one (pickling included) against
+# ~0.07ms to just process it here, so a pool only pays for itself with a few cores and a lot more situations than the
+# API normally gives us.
+PARALLEL_THRESHOLD = 20_000
+
+
+def worker_count() -> int:
+    """
+    Work out how many processes we can use to process the closures.
+
+    The WORKERS environment variable takes precedence. Otherwise, use the cores we're allowed to run on rather than
+    all those on the host, as we may be in a container.
+
+    Returns:
+        workers (int): The number of processes to use.
+
+    """
+
+    if "WORKERS" in os.environ:
+        return max(int(os.environ["WORKERS"]), 1)
+
+    # process_cpu_count only arrived in Python 3.13
+    if hasattr(os, "process_cpu_count"):
+        return os.process_cpu_count() or 1
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+
+    return os.cpu_count() or 1
+
+
+def process_situation(situation: dict, now: datetime, time_format: str) -> list[Closure]:
+    """
+    Pull the closures out of a single situation from the API.
+
+    This is a module-level function so it can be farmed out to worker processes.
+
+    Args:
+        situation (dict): A single situation from the raw closure payload.
+        now (datetime): The time against which to check the closure validity.
+        time_format (str): The time string formatting for the tooltip.
+
+    Returns:
+        closures (list[Closure]): The closures for the situation.
+
+    """
+
+    closures = []
+
+    records = situation["situationRecord"]
+    total_situation_records = len(records)
+    for ii, locations in enumerate(records, 1):
+        logger.debug("  Processing %d of %d situation records", ii, total_situation_records)
+        # Only display those that are certain to occur
+        validity = locations["probabilityOfOccurrence"].lower()
+        if validity != "certain":
+            continue
+
+        comment = locations["generalPublicComment"]
+        # Now we know it's valid, check for the time window
+        validity_spec = locations["validity"]
+        in_time = validity_spec["validityStatus"]
+        time_spec = validity_spec["validityTimeSpecification"]
+        start_time = parse_time(time_spec["overallStartTime"])
+        end_time = parse_time(time_spec["overallEndTime"])
+        if in_time == "definedByValidityTimeSpec":
+            if not start_time < now < end_time:
+                continue
+
+        cause = locations["cause"]["causeType"]
+        start = format_time(start_time, time_format)
+        end = format_time(end_time, time_format)
+
+        groups = locations["locationReference"]["locationReferencingLocationGroupByList"]["locationContainedInGroup"]
+        total_groups = len(groups)
+        for iii, location_group in enumerate(groups, 1):
+            logger.debug("    Processing %d of %d location groups", iii, total_groups)
+            closures.append(Closure(location_group, cause, start, end, comment))
+        logger.debug("    Finished processing location group")
+    logger.debug("  Finished processing situation records")
+
+    return closures
+
+
+def process_situations(situations: list[dict], now: datetime, time_format: str, colours: dict, pretty_causes: dict) -> list[dict]:
+    """
+    Pull the closures out of a batch of situations from the API, ready for drawing.
+
+    Only the render dictionaries are returned so that's all that has to be sent back from a worker process.
+
+    Args:
+        situations (list[dict]): The situations from the raw closure payload.
+        now (datetime): The time against which to check the closure validity.
+        time_format (str): The time string formatting for the tooltip.
+        colours (dict): The line colour for each closure cause.
+        pretty_causes (dict): The human readable name for each closure cause.
+
+    Returns:
+        closures (list[dict]): The render dictionaries for the closures in all the situations.
+
+    """
+
+    return [
+        closure.to_render_dict(colours, pretty_causes)
+        for situation in situations
+        for closure in process_situation(situation, now, time_format)
+    ]
 
 
 @dataclass
@@ -185,12 +387,16 @@ class Closures:
         key (str): The subscription key for the API.
         api_url (str, optional): The URL from which to fetch the closures.
         closures_file (Path, optional): File to store the closure JSON in. Defaults to closures.json.
-        processed_file (Path, optional) = File to store the processed closure JSON in. Defaults to processed.json.
+        processed_file (Path, optional) = File to store the processed closures in. Defaults to processed.npz.
         time_format (str, optional): The time string formatting for the tooltip. Defaults to "%d/%m/%Y %H:%M".
 
     Methods:
-        refresh_closures: Reload closures from the API or load from disk.
+        is_stale: Check whether the closures on disk need refreshing from the API.
+        refresh_closures: Reload closures from the API if necessary.
+        fetch_closures: Download the raw closures from the API to disk.
         process_closures: Extract the closures of interest and save to disk.
+        process_in_parallel: Process batches of situations across a pool of worker processes.
+        save_closures: Save the processed closures to disk.
         load_closures: Load processed closures from disk and populate object.
 
     """
@@ -198,10 +404,9 @@ class Closures:
     key: str
     api_url: Optional[str] = ("https://api.data.nationalhighways.co.uk/roads/v1.0/closures")
     closures_file: Optional[Path] = field(default=Path("closures.json"))
-    processed_file: Optional[Path] = field(default=Path("processed.json"))
+    processed_file: Optional[Path] = field(default=Path("processed.npz"))
     time_format: Optional[str] = "%d/%m/%Y %H:%M"
 
-    closures_payload: dict = field(init=False, default_factory=dict)
     closures: Optional[list[dict]] = field(init=False, default_factory=list)
 
     # Store whether we've fetched new data from the API data or not
@@ -245,23 +450,48 @@ class Closures:
 
         self.total_closures = len(self.closures)
 
-    def refresh_closures(self):
+    def is_stale(self) -> bool:
         """
-        Check the validity of the closures data and refresh if necessary.
+        Check whether the raw closures on disk are missing or out of date.
+
+        Returns:
+            stale (bool): True if fresh closures need fetching from the API.
 
         """
+        if not self.closures_file.exists() or self.closures_file.stat().st_size == 0:
+            return True
+
         now = datetime.now(ZoneInfo("Europe/London"))
+        closures_updated_time = datetime.fromtimestamp(self.closures_file.stat().st_mtime, ZoneInfo("Europe/London"))
 
+        # New closure information is published at 1400 daily. Check the existing closures file we have an adjust if we
+        # need to fetch new data. Check for that is if the file is more than 24 hours old _and_ we're beyond 1359
+        # (i.e. hour is greater than 13) or just that the file is over 24 hours old.
+        return closures_updated_time < (now - relativedelta(days=1)) or (now.hour > 13 and closures_updated_time < (now - relativedelta(days=1)))
+
+    def refresh_closures(self):
+        """
+        Check the validity of the closures data and refresh if necessary.
+
+        """
         if self.closures_file.exists() and self.closures_file.stat().st_size == 0:
             self.closures_file.unlink()
 
-        if self.closures_file.exists():
-            closures_updated_time = datetime.fromtimestamp(self.closures_file.stat().st_mtime, ZoneInfo("Europe/London"))
-            logger.info("Existing closures file created %f days ago", (now - closures_updated_time).total_seconds() / 86400)
+        if self.is_stale():
+            logger.info("Fetching raw closures from the API")
+            self.fetch_closures()
+            self.refreshed = True
         else:
-            logger.info("No existing closures file found")
-            closures_updated_time = now
+            logger.info("Using existing raw closures")
 
+    def fetch_closures(self):
+        """
+        Stream the raw closures from the API straight to disk.
+
+        The payload is written to a temporary file first and then moved into place so a failed download doesn't leave
+        a truncated closures file behind.
+
+        """
         headers = {
             "X-Response-MediaType": "application/json",
             "X-Djson-Format": "DATEXII",
@@ -269,23 +499,14 @@ class Closures:
             "Ocp-Apim-Subscription-Key": self.key,
         }
 
-        # New closure information is published at 1400 daily. Check the existing closures file we have an adjust if we
-        # need to fetch new data. Check for that is if the file is more than 24 hours old _and_ we're beyond 1359
-        # (i.e. hour is greater than 13) or just that the file is over 24 hours old.
-        if not self.closures_file.exists():
-            logger.info("Initial API raw closure fetch")
-            self.closures_payload = requests.get(self.api_url, headers=headers).json()
-            self.closures_file.write_text(json.dumps(self.closures_payload))
-            self.refreshed = True
-        elif self.closures_file.exists() and closures_updated_time < (now - relativedelta(days=1)) or (now.hour > 13 and closures_updated_time < (now - relativedelta(days=1))):
-            logger.info("Fresh raw closures API fetch")
-            self.closures_payload = requests.get(self.api_url, headers=headers).json()
-            self.closures_file.write_text(json.dumps(self.closures_payload))
-            self.refreshed = True
-        else:
-            logger.info("Loading existing raw closures from JSON")
-            self.closures_payload = json.loads(self.closures_file.read_text())
-            logger.info("Loaded existing raw closures from JSON")
+        download_file = self.closures_file.with_name(f"{self.closures_file.name}.part")
+        with _api_session.get(self.api_url, headers=headers, stream=True, timeout=30) as response, download_file.open("wb") as f:
+            # Don't let an error response replace the closures we already have
+            response.raise_for_status()
+            # Let urllib3 undo any transfer compression as we copy
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, f)
+        download_file.replace(self.closures_file)
 
     def process_closures(self) -> dict:
         """
@@ -297,8 +518,8 @@ class Closures:
             - Set tooltips for each segment
             - Create a set of coordinates
 
-        Args:
-            closures_payload (dict): The raw closure payload from the upstream API.
+        The situations are streamed from the raw closures file in batches, so we never hold the whole payload in
+        memory. Really large payloads are handed off to a pool of worker processes part way through.
 
         Returns:
             processed_closures (dict): The processed closures.
@@ -309,79 +530,187 @@ class Closures:
 
         now = datetime.now(ZoneInfo("Europe/London"))
 
-        total_situations = len(self.closures_payload["D2Payload"]["situation"])
-        for i, situation in enumerate(self.closures_payload["D2Payload"]["situation"], 1):
-            logger.debug("Processing %d of %d situations", i, total_situations)
-            total_situation_records = len(situation["situationRecord"])
-            for ii, locations in enumerate(situation["situationRecord"], 1):
-                logger.debug("  Processing %d of %d situation records", ii, total_situation_records)
-                # Only display those that are certain to occur
-                validity = locations["probabilityOfOccurrence"].lower()
-                if validity not in ("certain"):
+        workers = worker_count()
+        with self.closures_file.open("rb") as f:
+            situations = ijson.items(f, "D2Payload.situation.item", use_float=True)
+            batches = iter(lambda: list(itertools.islice(situations, SITUATION_CHUNK_SIZE)), [])
+            # Worker processes are expensive to start, so do the work here unless the payload turns out to be big
+            # enough for them to be worth it.
+            processed = 0
+            for batch in batches:
+                self.closures.extend(process_situations(batch, now, self.time_format, self.colours, self.pretty_causes))
+                processed += len(batch)
+                if workers > 1 and processed >= PARALLEL_THRESHOLD:
+                    self.process_in_parallel(batches, now, workers)
                     break
-
-                comment = locations["generalPublicComment"]
-                # Now we know it's valid, check for the time window
-                in_time = locations["validity"]["validityStatus"]
-                start_time, end_time = [locations["validity"]["validityTimeSpecification"][i] for i in ("overallStartTime", "overallEndTime")]
-                # Replace 'Z' with +00:00 to make a valid ISO spec time
-                start_time = datetime.fromisoformat(start_time.replace("Z", "+00:00"))
-                end_time = datetime.fromisoformat(end_time.replace("Z", "+00:00"))
-                if in_time == "definedByValidityTimeSpec":
-                    if not start_time < now < end_time:
-                        break
-
-                cause = locations["cause"]["causeType"]
-
-                total_groups = len(locations["locationReference"]["locationReferencingLocationGroupByList"]["locationContainedInGroup"])
-                for iii, location_group in enumerate(locations["locationReference"]["locationReferencingLocationGroupByList"]["locationContainedInGroup"], 1):
-                    logger.debug("    Processing %d of %d location groups", iii, total_groups)
-                    self.closures.append(
-                        Closure(
-                            location_group,
-                            cause,
-                            start_time.strftime(self.time_format),
-                            end_time.strftime(self.time_format),
-                            comment,
-                        )
-                    )
-                logger.debug("    Finished processing location group")
-            logger.debug("  Finished processing situation records")
         logger.debug("Finished processing situations")
 
-        self.processed_file.write_text(json.dumps([i.__dict__ for i in self.closures]))
+        self.save_closures()
+
+    def process_in_parallel(self, batches, now: datetime, workers: int):
+        """
+        Process batches of situations across a pool of worker processes.
+
+        Only a bounded number of batches are in flight at once, so we never hold the whole payload in memory.
+
+        Args:
+            batches (Iterator[list[dict]]): The batches of situations still to process.
+            now (datetime): The time against which to check the closure validity.
+            workers (int): The number of worker processes to use.
+
+        """
+
+        logger.debug(f"Processing the remaining situations with {workers} workers")
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            # We're inside a heavily threaded server, where forking is liable to deadlock
+            mp_context=multiprocessing.get_context("forkserver"),
+        ) as executor:
+            # Executor.map would read every situation up front, so submit the batches ourselves and only read more
+            # of the file once a batch has come back.
+            pending = deque()
+            for batch in batches:
+                # Nothing downstream needs the Closure machinery, so just get back what's needed to draw each closure.
+                pending.append(
+                    executor.submit(process_situations, batch, now, self.time_format, self.colours, self.pretty_causes)
+                )
+                if len(pending) >= 2 * workers:
+                    self.closures.extend(pending.popleft().result())
+            for future in pending:
+                self.closures.extend(future.result())
 
         logger.info("Processed closures")
 
+    def save_closures(self):
+        """
+        Save the processed closures to disk.
+
+        The coordinates for all the closures are stacked into a single array with the offsets of each closure into it
+        alongside. Everything else is stored as JSON. The coordinates are kept at full precision so a map drawn from
+        the saved closures is identical to one drawn straight after processing them.
+
+        """
+        logger.info("Saving processed closures")
+        coordinates = [closure["coordinates"] for closure in self.closures]
+        offsets = np.cumsum([0] + [len(i) for i in coordinates], dtype=np.int32)
+        if coordinates:
+            coordinates = np.concatenate(coordinates)
+        else:
+            coordinates = np.empty((0, 2))
+        meta = [{k: v for k, v in closure.items() if k != "coordinates"} for closure in self.closures]
+        np.savez_compressed(
+            self.processed_file,
+            coordinates=coordinates,
+            offsets=offsets,
+            meta=np.frombuffer(orjson.dumps(meta), dtype=np.uint8),
+        )
+        logger.info("Saved processed closures")
+
     def load_closures(self):
         """
-        Load processed closures from JSON and into a list of closures.
+        Load processed closures from disk as a list of dictionaries.
 
         """
-        logger.info("Loading processed closures from JSON")
+        logger.info("Loading processed closures")
         if self.processed_file.exists():
-            closures = json.loads(self.processed_file.read_text())
-            for closure in closures:
-                # Create an empty Closure object and then populate it from the JSON dictionary
-                c = Closure({}, "", "", "", [{"comment": ""}])
-                c.from_dict(closure)
-                self.closures.append(c)
-        logger.info("Loaded processed closures from JSON")
+            with np.load(self.processed_file) as processed:
+                coordinates = processed["coordinates"]
+                offsets = processed["offsets"]
+                self.closures = orjson.loads(processed["meta"].tobytes())
+            for closure, start, end in zip(self.closures, offsets[:-1], offsets[1:]):
+                closure["coordinates"] = coordinates[start:end]
+        logger.info("Loaded processed closures")
 
 
-@app.route("/")
-@app.route("/map")
-async def map() -> str:
+# Building the closures means parsing the full API payload, so hold on to them between requests and only rebuild when
+# the closures on disk change or go stale.
+_closures = {"instance": None, "mtime": 0}
+_closures_lock = threading.Lock()
+
+
+def get_closures(key: str) -> Closures:
     """
-    Render a map.
+    Fetch the shared closures, rebuilding them only when they are out of date.
+
+    Args:
+        key (str): The subscription key for the API.
+
+    Returns:
+        closures (Closures): The current closures.
+
+    """
+
+    with _closures_lock:
+        closures = _closures["instance"]
+        if closures is not None:
+            mtime = closures.closures_file.stat().st_mtime_ns if closures.closures_file.exists() else 0
+            if mtime == _closures["mtime"] and not closures.is_stale():
+                return closures
+
+        logger.info("Building closures")
+        closures = Closures(key)
+        _closures["instance"] = closures
+        _closures["mtime"] = closures.closures_file.stat().st_mtime_ns
+        logger.info("Built closures")
+
+        return closures
+
+
+def map_response(map_html: str, etag: str, last_modified: float) -> flask.Response:
+    """
+    Wrap the rendered map in a response, honouring any conditional headers from the client.
+
+    Args:
+        map_html (str): The rendered HTML for the page.
+        etag (str): The entity tag for the rendered HTML.
+        last_modified (float): When the HTML was rendered (as a POSIX timestamp).
 
     Returns:
-        page (str): The rendered HTML for the page template.
+        response (flask.Response): The response to send (a 304 if the client is up to date).
+
+    """
+
+    response = flask.make_response(map_html)
+    # Cache for 1 hour, but let clients use a stale copy while they check for a new one
+    response.headers["Cache-Control"] = "public, max-age=3600, stale-while-revalidate=86400"
+    response.set_etag(etag)
+    response.last_modified = last_modified
+
+    # Sort out If-None-Match and If-Modified-Since; this drops the body if the client is up to date.
+    response = response.make_conditional(flask.request)
+    if response.status_code == 304:
+        logger.info("Client map is up to date")
 
+    return response
+
+
+def closure_style(feature: dict) -> dict:
     """
+    Style a closure on the map.
 
-    # Fetch, process and style all the road closures from the API
-    closures = Closures(app.key)
+    Args:
+        feature (dict): The GeoJSON feature for the closure.
+
+    Returns:
+        style (dict): The Leaflet path options for the closure.
+
+    """
+
+    return {"color": feature["properties"]["color"], "weight": 5, "opacity": feature["properties"]["alpha"]}
+
+
+def render_map(closures: Closures) -> str:
+    """
+    Draw the closures on a map and render the page template around it.
+
+    Args:
+        closures (Closures): The closures to draw.
+
+    Returns:
+        map_html (str): The rendered HTML for the page.
+
+    """
 
     # Use our customised Map class (no default CSS)
     m = Map(
@@ -390,61 +719,183 @@ async def map() -> str:
         zoom_start=7,  # most of the country
     )
 
-    map_file = Path("map.html")
-
-    if closures.refreshed or not map_file.exists():
-        for i, closure in enumerate(closures.closures, 1):
-            logger.debug("Processing %d of %d closures", i, closures.total_closures)
-
-            tooltip_content = f"""
-            <div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.4;">
-                <b>Name:</b> {closure.info['name']}<br>
-                <b>Description:</b> {closure.info['description']}<br>
-                <b>From:</b> {closure.info['start']}<br>
-                <b>To:</b> {closure.info['end']}<br>
-                <b>Cause:</b> {closures.pretty_causes[closure.cause]}<br>
-                <b>Open carriageways:</b> {closure.info['open']}<br>
-                <b>Closed carriageways:</b> {closure.info['closed']}
-            </div>
-            """
-
-            folium.PolyLine(
-                locations=closure.coordinates,
-                color=closures.colours[closure.cause],
-                weight=5,
-                opacity=closure.alpha,
-                tooltip=folium.Tooltip(tooltip_content),
-            ).add_to(m)
-
-        logger.info("Rendering HTML template")
+    # Draw all the closures as a single GeoJSON layer rather than one folium object (and template render) per closure.
+    features = [
+        {
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": closure["coordinates"].tolist()},
+            "properties": {k: closure[k] for k in ("color", "alpha", "tooltip_html", "cause")},
+        }
+        for closure in closures.closures
+    ]
+    logger.debug("Drawing %d closures", len(features))
+
+    # The tooltip needs at least one feature to find its field in, so leave the map blank if there's nothing to draw.
+    if features:
+        folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            style_function=closure_style,
+            tooltip=folium.GeoJsonTooltip(fields=["tooltip_html"], labels=False),
+        ).add_to(m)
+
+    logger.info("Rendering HTML template")
+    with app.app_context():
         map_html = flask.render_template("index.html", map_html=m.get_root().render())
-        logger.info("Rendered HTML template")
-        logger.info("Saving HTML to disk")
-        map_file.write_text(map_html)
-        logger.info("Saved HTML to disk")
-    else:
-        logger.info("Loading HTML from disk")
-        map_html = map_file.read_text()
-        logger.info("Loaded HTML from disk")
+    logger.info("Rendered HTML template")
 
-    # Render the template with the map
-    response = flask.make_response(map_html)
-    response.headers["Cache-Control"] = "public, max-age=3600"  # Cache for 1 hour
+    return map_html
 
-    return response
+
+# Only let one thread at a time refresh the map so simultaneous cold hits don't all fetch and render it.
+_build_lock = threading.Lock()
+
+
+def build_map(key: str) -> tuple[str, str, float]:
+    """
+    Bring the cached map up to date with the closures, fetching and rendering them if needed.
+
+    This does all the slow, blocking work, so keep it off the request's event loop.
+
+    Args:
+        key (str): The subscription key for the API.
+
+    Returns:
+        map_html (str): The rendered HTML for the page.
+        etag (str): The entity tag for the rendered HTML.
+        mtime (float): When the HTML was rendered (as a POSIX timestamp).
+
+    """
+
+    with _build_lock:
+        # Fetch, process and style all the road closures from the API
+        closures = get_closures(key)
+
+        map_file = Path("map.html")
+
+        with app._map_cache_lock:
+            # The cached HTML is current if it was made from the closures we've just been given.
+            if app._map_cache["html"] is not None and app._map_cache["closures"] is closures:
+                logger.debug("Using cached HTML")
+                return app._map_cache["html"], app._map_cache["etag"], app._map_cache["mtime"]
+
+        if closures.refreshed or not map_file.exists():
+            map_html = render_map(closures)
+            logger.info("Saving HTML to disk")
+            map_file.write_text(map_html)
+            logger.info("Saved HTML to disk")
+            mtime = time.time()
+        else:
+            # Only go to disk on a cold start; after that, serve the HTML from memory.
+            logger.info("Loading HTML from disk")
+            map_html = map_file.read_text()
+            logger.info("Loaded HTML from disk")
+            mtime = map_file.stat().st_mtime
+
+        etag = hashlib.sha1(map_html.encode()).hexdigest()
+        with app._map_cache_lock:
+            app._map_cache["html"] = map_html
+            app._map_cache["etag"] = etag
+            app._map_cache["mtime"] = mtime
+            app._map_cache["closures"] = closures
+
+        return map_html, etag, mtime
+
+
+def refresh_loop(key: str) -> None:
+    """
+    Keep the cached map up to date in the background so requests never have to wait for a refresh.
+
+    Args:
+        key (str): The subscription key for the API.
+
+    """
+
+    while True:
+        try:
+            build_map(key)
+        except Exception:
+            logger.exception("Failed to refresh the map")
+
+        # Checking is cheap when nothing has changed, so do it often.
+        time.sleep(REFRESH_INTERVAL)
+
+
+# The background refresh thread. There should only ever be one, however the app is started.
+_refresher = {"thread": None}
+_refresher_lock = threading.Lock()
+
+
+def start_refresher(key: str) -> threading.Thread:
+    """
+    Start refreshing the map in a background thread, unless that's already happening.
+
+    Args:
+        key (str): The subscription key for the API.
+
+    Returns:
+        thread (threading.Thread): The running refresh thread.
+
+    """
+
+    with _refresher_lock:
+        if _refresher["thread"] is None or not _refresher["thread"].is_alive():
+            _refresher["thread"] = threading.Thread(target=refresh_loop, args=(key,), name="map-refresher", daemon=True)
+            _refresher["thread"].start()
+
+        return _refresher["thread"]
+
+
+async def serve_map() -> flask.Response:
+    """
+    Serve the map page, from the cache if possible.
+
+    Returns:
+        response (flask.Response): The response with the rendered map page.
+
+    """
+
+    # Keeping the map up to date is the background refresh's job, so if we've got a map at all, serve it without even
+    # checking the closures. That way requests don't pile up behind a refresh that's stuck waiting on the API.
+    with app._map_cache_lock:
+        if app._map_cache["html"] is not None:
+            logger.debug("Using cached HTML")
+            return map_response(app._map_cache["html"], app._map_cache["etag"], app._map_cache["mtime"])
+
+    # Only on a cold start do we have to build the map ourselves. When we're not started through run() (e.g. under
+    # waitress-serve or flask run), nothing will have started the background refresh yet either, so do that now too.
+    start_refresher(app.key)
+
+    # Building the map is blocking, so run it in a worker thread rather than on the event loop.
+    map_html, etag, mtime = await asyncio.to_thread(build_map, app.key)
+
+    return map_response(map_html, etag, mtime)
+
+
+@app.route("/")
+@app.route("/map")
+async def map() -> flask.Response:
+    """
+    Render a map.
+
+    Returns:
+        response (flask.Response): The response with the rendered map page.
+
+    """
+
+    return await serve_map()
 
 
 @app.route("/contact")
 @app.route("/data")
-async def placeholder() -> None:
+async def placeholder() -> flask.Response:
     """
-    Placeholder function which just calls the map page.
+    Placeholder function which just serves the map page.
 
     Returns:
-        map (str): The map HTML.
+        response (flask.Response): The response with the rendered map page.
     """
 
-    return await map()
+    return await serve_map()
 
 
 @app.route("/robots.txt")
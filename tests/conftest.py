@@ -0,0 +1,94 @@
+"""
+Shared fixtures for the highways map tests.
+
+"""
+
+import os
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import pytest
+
+# The app refuses to start without an API key, so give it a dummy one before it's imported.
+os.environ.setdefault("SUBSCRIPTION_KEY", "test-key")
+
+from highwaysmap import main  # noqa: E402
+
+
+def make_record(probability="Certain", cause="roadMaintenance", comment="Closed for resurfacing", pos_list="-1.0 51.0 -1.1 51.1"):
+    """
+    Make a single situation record as the API returns them, valid from yesterday until tomorrow.
+
+    """
+
+    now = datetime.now(timezone.utc)
+    return {
+        "probabilityOfOccurrence": probability,
+        "generalPublicComment": [{"comment": comment}],
+        "validity": {
+            "validityStatus": "definedByValidityTimeSpec",
+            "validityTimeSpecification": {
+                "overallStartTime": (now - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "overallEndTime": (now + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            },
+        },
+        "cause": {"causeType": cause},
+        "locationReference": {
+            "locationReferencingLocationGroupByList": {
+                "locationContainedInGroup": [
+                    {
+                        "locationReferencingPointLocation": {
+                            "pointAlongLinearElement": [
+                                {"linearElement": {"roadName": "M1"}},
+                                {"linearElement": {"roadName": "M1"}},
+                            ]
+                        },
+                        "locationReferencingLinearLocation": {
+                            "gmlLineString": {"posList": pos_list},
+                            "supplementaryPositionalDescription": {
+                                "carriageway": [
+                                    {
+                                        "_carriagewayExtensionG": {
+                                            "numberOfOperationalLanes": 0,
+                                            "numberOfLanesRestricted": 2,
+                                        }
+                                    }
+                                ]
+                            },
+                        },
+                    }
+                ]
+            }
+        },
+    }
+
+
+def write_closures(records):
+    """
+    Write a raw closures file holding a single situation made of the given records.
+
+    """
+
+    payload = {"D2Payload": {"situation": [{"situationRecord": records}]}}
+    main.Closures.closures_file.write_bytes(orjson.dumps(payload))
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """
+    Run each test in its own directory with empty caches and no background refresh.
+
+    """
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main.app, "_map_cache", {"html": None, "etag": None, "mtime": 0, "closures": None})
+    monkeypatch.setattr(main, "_closures", {"instance": None, "mtime": 0})
+    monkeypatch.setattr(main, "_refresher", {"thread": None})
+    monkeypatch.setattr(main, "refresh_loop", lambda key: None)
+
+    return tmp_path
+
+
+@pytest.fixture
+def app():
+    return main.app
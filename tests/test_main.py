@@ -0,0 +1,207 @@
+"""
+Tests for the highways map app.
+
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import orjson
+import pytest
+import requests
+from conftest import make_record, write_closures
+
+from highwaysmap import main
+
+
+def test_process_situation_skips_uncertain_records():
+    # An uncertain record shouldn't stop later records in the same situation from being processed
+    situation = {"situationRecord": [make_record(probability="Probable"), make_record(cause="constructionWork")]}
+
+    closures = main.process_situation(situation, datetime.now(ZoneInfo("Europe/London")), "%d/%m/%Y %H:%M")
+
+    assert [closure.cause for closure in closures] == ["constructionWork"]
+
+
+def test_map_not_modified(client):
+    write_closures([make_record()])
+
+    response = client.get("/")
+    assert response.status_code == 200
+
+    assert client.get("/", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    assert client.get("/", headers={"If-Modified-Since": response.headers["Last-Modified"]}).status_code == 304
+
+
+def test_map_not_modified_compressed(client):
+    write_closures([make_record()])
+
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+
+    # Compression changes the ETag, so make sure the compressed one is honoured too
+    response = client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+
+def test_process_closures_in_batches():
+    # Enough situations to need several batches
+    situations = [{"situationRecord": [make_record(comment=f"Closure {i}")]} for i in range(5 * main.SITUATION_CHUNK_SIZE)]
+    main.Closures.closures_file.write_bytes(orjson.dumps({"D2Payload": {"situation": situations}}))
+
+    closures = main.Closures("test-key")
+
+    assert not closures.refreshed
+    assert closures.total_closures == len(situations)
+    assert [f"Closure {i}<br>" in closure["tooltip_html"] for i, closure in enumerate(closures.closures)] == [True] * len(situations)
+
+
+def test_small_payload_processed_without_pool(monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("Started a process pool")
+
+    monkeypatch.setattr(main, "ProcessPoolExecutor", no_pool)
+    monkeypatch.setenv("WORKERS", "4")
+    write_closures([make_record()])
+
+    closures = main.Closures("test-key")
+
+    assert closures.total_closures == 1
+
+
+def test_large_payload_processed_in_parallel(monkeypatch):
+    # Switch to the pool after the first batch
+    monkeypatch.setattr(main, "PARALLEL_THRESHOLD", main.SITUATION_CHUNK_SIZE)
+    monkeypatch.setenv("WORKERS", "2")
+    pools = []
+    pool = main.ProcessPoolExecutor
+    monkeypatch.setattr(main, "ProcessPoolExecutor", lambda **kwargs: pools.append(kwargs) or pool(**kwargs))
+    situations = [{"situationRecord": [make_record(comment=f"Closure {i}")]} for i in range(5 * main.SITUATION_CHUNK_SIZE)]
+    main.Closures.closures_file.write_bytes(orjson.dumps({"D2Payload": {"situation": situations}}))
+
+    closures = main.Closures("test-key")
+
+    assert [kwargs["max_workers"] for kwargs in pools] == [2]
+    assert [f"Closure {i}<br>" in closure["tooltip_html"] for i, closure in enumerate(closures.closures)] == [True] * len(situations)
+
+
+@pytest.mark.parametrize("workers, expected", [("3", 3), ("0", 1)])
+def test_worker_count_from_environment(monkeypatch, workers, expected):
+    monkeypatch.setenv("WORKERS", workers)
+
+    assert main.worker_count() == expected
+
+
+class ErrorResponse:
+    """
+    A stand in for a streamed error response from the API.
+
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        raise requests.HTTPError("401 Client Error: Access Denied")
+
+
+def test_failed_fetch_keeps_existing_closures(monkeypatch):
+    write_closures([make_record()])
+    raw = main.Closures.closures_file.read_bytes()
+    # Make the closures old enough to need refreshing
+    old = time.time() - 2 * 86400
+    os.utime(main.Closures.closures_file, (old, old))
+
+    monkeypatch.setattr(main._api_session, "get", lambda *args, **kwargs: ErrorResponse())
+    with pytest.raises(requests.HTTPError):
+        main.Closures("test-key")
+
+    assert main.Closures.closures_file.read_bytes() == raw
+
+
+def test_map_served_from_cache_when_refresh_fails(client, monkeypatch):
+    write_closures([make_record()])
+    response = client.get("/")
+    assert response.status_code == 200
+
+    def broken(key):
+        raise requests.ConnectionError("API unavailable")
+
+    # Requests shouldn't wait on (or fail with) a refresh when there's already a map to serve
+    monkeypatch.setattr(main, "build_map", broken)
+    for url in ("/", "/map", "/data", "/contact"):
+        cached = client.get(url)
+        assert cached.status_code == 200
+        assert cached.data == response.data
+
+
+def test_saved_closures_round_trip():
+    write_closures([
+        make_record(pos_list="-1.234567 51.6 -1.1 51.123456"),
+        make_record(cause="other", pos_list="0.1 52.0 0.2 52.1 0.3 52.2"),
+    ])
+    processed = main.Closures("test-key")
+    assert main.Closures.processed_file.exists()
+
+    # Nothing has changed, so this time the closures come from the saved file
+    loaded = main.Closures("test-key")
+
+    assert loaded.total_closures == processed.total_closures == 2
+    for original, reloaded in zip(processed.closures, loaded.closures):
+        assert np.array_equal(original["coordinates"], reloaded["coordinates"])
+        assert {k: v for k, v in original.items() if k != "coordinates"} == {k: v for k, v in reloaded.items() if k != "coordinates"}
+
+
+def test_saved_closures_round_trip_empty():
+    write_closures([make_record(probability="Probable")])
+    main.Closures("test-key")
+
+    assert main.Closures("test-key").closures == []
+
+
+def test_map_without_closures(client):
+    write_closures([make_record(probability="Probable")])
+
+    response = client.get("/")
+
+    assert response.status_code == 200
+    assert b"geo_json" not in response.data
+
+
+def test_cold_start_starts_refresher_once(client, monkeypatch):
+    refreshing = []
+    stop = threading.Event()
+    monkeypatch.setattr(main, "refresh_loop", lambda key: refreshing.append(key) or stop.wait())
+    write_closures([make_record()])
+
+    try:
+        assert client.get("/").status_code == 200
+        refresher = main._refresher["thread"]
+        # Another cold start mustn't start a second refresh
+        main.app._map_cache["html"] = None
+        assert client.get("/").status_code == 200
+        assert main._refresher["thread"] is refresher
+        assert refresher.is_alive()
+    finally:
+        stop.set()
+
+    refresher.join(timeout=5)
+    assert refreshing == [main.app.key]
+
+
+def test_map_draws_closures_as_geojson(client):
+    write_closures([make_record(pos_list="-1.5 51.5 -1.6 51.6")])
+
+    response = client.get("/")
+
+    assert response.status_code == 200
+    # GeoJSON coordinates are lon/lat, the same as the API gives them
+    assert b'"coordinates": [[-1.5, 51.5], [-1.6, 51.6]]' in response.data